@@ -5,31 +5,148 @@ At some point we may want to create dedicated classes for each type of data retu
 but then we'll also need to implement join logic between these classes.
 """
 
+import json
 import pandas as pd
+import pytz
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+try:
+    import ciso8601  # optional, much faster than pandas for parsing ISO-8601 strings
+except ImportError:
+    ciso8601 = None
 
 FTS_BASE_URL = 'http://fts.unocha.org/api/v1/'
 JSON_SUFFIX = '.json'
 
+# URLs for the queries made once per appeal or emergency are built from precomputed templates,
+# anything run only once just uses build_json_url
+_PROJECTS_FOR_APPEAL_URL = FTS_BASE_URL + 'Project/appeal/%s' + JSON_SUFFIX
+_CONTRIBUTIONS_FOR_APPEAL_URL = FTS_BASE_URL + 'Contribution/appeal/%s' + JSON_SUFFIX
+_CONTRIBUTIONS_FOR_EMERGENCY_URL = FTS_BASE_URL + 'Contribution/emergency/%s' + JSON_SUFFIX
+
+REQUEST_TIMEOUT_SECONDS = 30
+# connections kept alive by the session, i.e. per process; size it to the number of requests one process makes at once,
+# since any beyond that still go out but their connections are closed afterwards rather than reused
+CONNECTION_POOL_SIZE = 20
+
+
+def build_session():
+    session = requests.Session()
+    session.headers.update({'Accept-Encoding': 'gzip', 'Connection': 'keep-alive'})
+    # retry transient failures rather than losing a whole country's worth of data to one dropped connection
+    adapter = HTTPAdapter(pool_connections=CONNECTION_POOL_SIZE, pool_maxsize=CONNECTION_POOL_SIZE,
+                          max_retries=Retry(total=3, backoff_factor=0.3))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+# shared so that connections to the FTS API are kept alive and reused across the many per-appeal requests
+_SESSION = build_session()
+
+
+def reset_session():
+    """
+    Connections can't be shared between processes, so call this at the start of any worker process.
+    """
+    global _SESSION
+    _SESSION = build_session()
+
+
+# optional semaphore bounding how many requests are in flight at once, see limit_concurrent_requests
+_request_slots = None
+
+
+def limit_concurrent_requests(request_slots):
+    """
+    Any semaphore will do, but use a multiprocessing one (passed to each worker process) for the limit to hold
+    across processes as well as threads.
+    """
+    global _request_slots
+    _request_slots = request_slots
+
+
+def fetch_json(url):
+    if _request_slots is None:
+        response = _SESSION.get(url, timeout=REQUEST_TIMEOUT_SECONDS)
+    else:
+        with _request_slots:
+            response = _SESSION.get(url, timeout=REQUEST_TIMEOUT_SECONDS)
+    response.raise_for_status()
+    return json.loads(response.content)
+
+
+def coerce_dtypes_like_read_json(dataframe):
+    """
+    pd.read_json converts numeric strings to numbers and whole-valued float columns to integers,
+    but building a dataframe from decoded JSON doesn't, so do the same here to keep the CSV output unchanged
+    """
+    for column_name in dataframe.columns:
+        column = dataframe[column_name]
+        if column.dtype.kind == 'O':
+            try:
+                column = pd.to_numeric(column)
+            except (ValueError, TypeError):
+                continue  # genuinely text (or nested data)
+        if column.dtype.kind == 'f' and column.notnull().all() and (column == column.astype('int64')).all():
+            column = column.astype('int64')
+        dataframe[column_name] = column
+    return dataframe
+
 
 def fetch_json_as_dataframe(url):
-    return pd.read_json(url)
+    return coerce_dtypes_like_read_json(pd.DataFrame(fetch_json(url)))
 
 
 def fetch_json_as_dataframe_with_id(url):
-    dataframe = fetch_json_as_dataframe(url)
+    data = fetch_json(url)
+    if not data:
+        return pd.DataFrame()  # an empty result has no id column to index on
+    dataframe = coerce_dtypes_like_read_json(pd.DataFrame(data))
     if 'id' in dataframe.columns:
-        return dataframe.set_index('id')
-    else:
-        return dataframe  # happens with an empty result
+        dataframe.set_index('id', inplace=True)
+    return dataframe
 
 
 def build_json_url(middle_part):
     return FTS_BASE_URL + middle_part + JSON_SUFFIX
 
 
+def parse_iso_8601_date_with_ciso8601(value):
+    # missing dates come through as None or NaN rather than as strings
+    if not isinstance(value, basestring) or not value:
+        return pd.NaT
+    try:
+        parsed = ciso8601.parse_datetime(value)
+    except ValueError:
+        return pd.NaT  # malformed, as with errors='coerce' below
+    if parsed is None:
+        return pd.NaT  # ciso8601 1.x returns None for malformed dates rather than raising
+    if parsed.tzinfo is not None:
+        # pandas' parsing below converts dates with a UTC offset to naive UTC, so do the same
+        parsed = parsed.astimezone(pytz.utc).replace(tzinfo=None)
+    return parsed
+
+
+def parse_iso_8601_dates(values):
+    if ciso8601:
+        return pd.DatetimeIndex([parse_iso_8601_date_with_ciso8601(value) for value in values])
+    # parse the whole column at once rather than calling a Python-level parser per cell,
+    # caching as many rows share the same date
+    return pd.to_datetime(values, errors='coerce', cache=True)
+
+
 def convert_date_columns_from_string_to_timestamp(dataframe, column_names):
+    """
+    All FTS dates are ISO-8601 strings, so any new fetch_*_as_dataframe_given_url function should go through
+    this rather than parsing dates itself. Empty results (which have no columns) are left alone.
+    """
+    if dataframe.empty:
+        return
     for column_name in column_names:
-        dataframe[column_name] = dataframe[column_name].apply(pd.datetools.parse)
+        dataframe[column_name] = parse_iso_8601_dates(dataframe[column_name].values)
 
 
 def fetch_sectors_json_as_dataframe():
@@ -73,9 +190,8 @@ def fetch_appeals_json_for_year_as_dataframe(year):
 
 
 def fetch_projects_json_for_appeal_as_dataframe(appeal_id):
-    dataframe = fetch_json_as_dataframe_with_id(build_json_url('Project/appeal/' + str(appeal_id)))
-    if not dataframe.empty:  # guard against empty result
-        convert_date_columns_from_string_to_timestamp(dataframe, ['end_date', 'last_updated_datetime'])
+    dataframe = fetch_json_as_dataframe_with_id(_PROJECTS_FOR_APPEAL_URL % appeal_id)
+    convert_date_columns_from_string_to_timestamp(dataframe, ['end_date', 'last_updated_datetime'])
     return dataframe
 
 
@@ -86,18 +202,16 @@ def fetch_clusters_json_for_appeal_as_dataframe(appeal_id):
 
 def fetch_contributions_json_as_dataframe_given_url(url):
     dataframe = fetch_json_as_dataframe_with_id(url)
-    if not dataframe.empty:  # guard against empty result
-        convert_date_columns_from_string_to_timestamp(dataframe, ['decision_date'])
+    convert_date_columns_from_string_to_timestamp(dataframe, ['decision_date'])
     return dataframe
 
 
 def fetch_contributions_json_for_appeal_as_dataframe(appeal_id):
-    return fetch_contributions_json_as_dataframe_given_url(build_json_url('Contribution/appeal/' + str(appeal_id)))
+    return fetch_contributions_json_as_dataframe_given_url(_CONTRIBUTIONS_FOR_APPEAL_URL % appeal_id)
 
 
 def fetch_contributions_json_for_emergency_as_dataframe(emergency_id):
-    return fetch_contributions_json_as_dataframe_given_url(
-        build_json_url('Contribution/emergency/' + str(emergency_id)))
+    return fetch_contributions_json_as_dataframe_given_url(_CONTRIBUTIONS_FOR_EMERGENCY_URL % emergency_id)
 
 
 def fetch_grouping_type_json_for_appeal_as_dataframe(middle_part, appeal_id, grouping=None, alias=None):
@@ -118,14 +232,23 @@ def fetch_grouping_type_json_for_appeal_as_dataframe(middle_part, appeal_id, gro
         url += '&GroupBy=' + grouping
 
     # NOTE no id present in this data
-    raw_dataframe = fetch_json_as_dataframe(url)
+    data = fetch_json(url)
 
-    # oddly the JSON of interest is nested inside the "grouping" element
-    processed_frame = pd.DataFrame.from_records(raw_dataframe.grouping.values)
+    # oddly the JSON of interest is nested inside the "grouping" element, so pull that out directly
+    # rather than building a dataframe of the whole response first
+    if isinstance(data, dict):
+        records = data['grouping']
+    else:
+        records = [row['grouping'] for row in data]
+    types = [record['type'] for record in records]
+    amounts = [record['amount'] for record in records]
 
+    # build the columns under their final names directly rather than renaming afterwards
     if alias:
-        processed_frame = processed_frame.rename(columns={'type': alias, 'amount': middle_part})
-        processed_frame = processed_frame.set_index(alias)
+        processed_frame = pd.DataFrame({alias: types, middle_part: amounts}, columns=[alias, middle_part])
+        processed_frame.set_index(alias, inplace=True)
+    else:
+        processed_frame = pd.DataFrame({'type': types, 'amount': amounts}, columns=['amount', 'type'])
 
     return processed_frame
 
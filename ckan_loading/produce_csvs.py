@@ -7,60 +7,152 @@ Can be used to produce the following CSV files for upload into CKAN:
   - appeals.csv (for a given country)
   - projects.csv (for a given country, based on appeals)
   - contributions.csv (for given country, based on emergencies, which should capture all appeals, also)
+Setting OUTPUT_FORMAT to 'parquet' produces the same files in Parquet format instead.
 """
 
+import errno
 import fts_queries
 import os
 import pandas as pd
+import threading
+from functools import partial
+from multiprocessing import BoundedSemaphore, Pool
+from multiprocessing.pool import ThreadPool
 
 # TODO extract strings to header section above the code
 
+# upper bound on simultaneous requests to the FTS API across the whole run
+MAX_CONCURRENT_REQUESTS = 20
 
-def build_csv_path(base_path, object_type, country=None):
+# countries are processed in separate processes
+MAX_CONCURRENT_COUNTRIES = 4
+
+# CKAN expects CSV, but 'parquet' is much quicker to write and smaller on disk (requires pyarrow or fastparquet)
+OUTPUT_FORMAT = 'csv'
+
+
+def build_output_path(base_path, object_type, country=None):
     """
     Using CSV names that duplicate the file paths here, which generally I don't like,
     but having very explicit filenames is maybe nicer to sort out for CKAN.
     """
-    filename = 'fts_' + object_type + '.csv'
+    filename = 'fts_' + object_type + '.' + OUTPUT_FORMAT
 
     if country:  # a little bit of duplication but easier to read
-        filename = 'fts_' + country + '_' + object_type + '.csv'
+        filename = 'fts_' + country + '_' + object_type + '.' + OUTPUT_FORMAT
 
     return os.path.join(base_path, filename)
 
 
+def make_directories(path):
+    """
+    Equivalent to os.makedirs(path, exist_ok=True), which isn't available in Python 2.
+    Doesn't check for existence first, so there's no race with another worker creating the same directory.
+    """
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
+
+
+def contains_non_ascii_text(dataframe):
+    for column_name in dataframe.select_dtypes(include=['object']).columns:
+        text_values = [value for value in dataframe[column_name].values if isinstance(value, basestring)]
+        try:
+            u''.join(text_values).encode('ascii')
+        except UnicodeError:
+            return True
+    return False
+
+
 def write_dataframe_to_csv(dataframe, path):
     print "Writing", path
-    # include the index which is an ID for each of the objects serialized by this script
-    # use Unicode as many non-ASCII characters present in this data
-    dataframe.to_csv(path, index=True, encoding='utf-8')
+    # include the index which is an ID for each of the objects serialized by this script,
+    # but as an ordinary column since pandas is much slower writing out an index
+    # an unnamed index (as on an empty result) isn't an ID, so is written out as before rather than gaining a header
+    index_is_id = bool(dataframe.index.name)
+    if index_is_id:
+        dataframe = dataframe.reset_index()
+
+    # use Unicode as many non-ASCII characters present in this data, but only when needed
+    # since passing an encoding pushes pandas onto a much slower writer
+    if contains_non_ascii_text(dataframe):
+        dataframe.to_csv(path, index=not index_is_id, encoding='utf-8')
+    else:
+        dataframe.to_csv(path, index=not index_is_id)
+
+
+def write_dataframe(dataframe, path):
+    if OUTPUT_FORMAT == 'parquet':
+        print "Writing", path
+        # the index is kept, as with CSV
+        dataframe.to_parquet(path, compression='snappy')
+    else:
+        write_dataframe_to_csv(dataframe, path)
+
 
+# shared by every thread and every country process, so MAX_CONCURRENT_REQUESTS holds however the work is split up
+# (a fetch pool can use all of it when it's the only one running, e.g. for the last country to finish)
+_request_slots = BoundedSemaphore(MAX_CONCURRENT_REQUESTS)
+fts_queries.limit_concurrent_requests(_request_slots)
 
-def filter_out_empty_dataframes(dataframes):
-    # empty dataframes will fail the "if" test
-    return [frame for frame in dataframes if not frame.empty]
+
+def fetch_all_concurrently(fetch_function, ids):
+    """
+    The per-appeal and per-emergency fetches are independent and spend nearly all their time waiting on the network,
+    so run them on a pool of threads. Results are returned in the same order as the ids.
+    """
+    pool = ThreadPool(MAX_CONCURRENT_REQUESTS)
+    try:
+        return pool.map(fetch_function, ids)
+    finally:
+        pool.close()
+        pool.join()
+
+
+# appeals and emergencies are each needed by two of the per-country CSVs, so keep them around rather than re-fetching
+# NOTE the cached dataframes are shared, so callers shouldn't modify them
+# the locks stop two threads from both fetching the same country when neither finds it cached
+_appeals_by_country = {}
+_appeals_lock = threading.Lock()
+_emergencies_by_country = {}
+_emergencies_lock = threading.Lock()
+
+
+def fetch_appeals_for_country(country):
+    with _appeals_lock:
+        if country not in _appeals_by_country:
+            _appeals_by_country[country] = fts_queries.fetch_appeals_json_for_country_as_dataframe(country)
+        return _appeals_by_country[country]
+
+
+def fetch_emergencies_for_country(country):
+    with _emergencies_lock:
+        if country not in _emergencies_by_country:
+            _emergencies_by_country[country] = fts_queries.fetch_emergencies_json_for_country_as_dataframe(country)
+        return _emergencies_by_country[country]
 
 
 def produce_sectors_csv(output_dir):
     sectors = fts_queries.fetch_sectors_json_as_dataframe()
-    write_dataframe_to_csv(sectors, build_csv_path(output_dir, 'sectors'))
+    write_dataframe(sectors, build_output_path(output_dir, 'sectors'))
 
 
 def produce_countries_csv(output_dir):
     countries = fts_queries.fetch_countries_json_as_dataframe()
-    write_dataframe_to_csv(countries, build_csv_path(output_dir, 'countries'))
+    write_dataframe(countries, build_output_path(output_dir, 'countries'))
 
 
 def produce_organizations_csv(output_dir):
     organizations = fts_queries.fetch_organizations_json_as_dataframe()
-    write_dataframe_to_csv(organizations, build_csv_path(output_dir, 'organizations'))
+    write_dataframe(organizations, build_output_path(output_dir, 'organizations'))
 
 
 def produce_global_csvs(base_output_dir):
     # not sure if this directory creation code should be somewhere else..?
     output_dir = os.path.join(base_output_dir, 'fts', 'global')
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+    make_directories(output_dir)
 
     produce_sectors_csv(output_dir)
     produce_countries_csv(output_dir)
@@ -68,47 +160,71 @@ def produce_global_csvs(base_output_dir):
 
 
 def produce_emergencies_csv_for_country(output_dir, country):
-    emergencies = fts_queries.fetch_emergencies_json_for_country_as_dataframe(country)
-    write_dataframe_to_csv(emergencies, build_csv_path(output_dir, 'emergencies', country=country))
+    emergencies = fetch_emergencies_for_country(country)
+    write_dataframe(emergencies, build_output_path(output_dir, 'emergencies', country=country))
 
 
 def produce_appeals_csv_for_country(output_dir, country):
-    appeals = fts_queries.fetch_appeals_json_for_country_as_dataframe(country)
-    write_dataframe_to_csv(appeals, build_csv_path(output_dir, 'appeals', country=country))
+    appeals = fetch_appeals_for_country(country)
+    write_dataframe(appeals, build_output_path(output_dir, 'appeals', country=country))
 
 
 def produce_projects_csv_for_country(output_dir, country):
-    # first get all appeals for this country (could eliminate this duplicative call, but it's not expensive)
-    appeals = fts_queries.fetch_appeals_json_for_country_as_dataframe(country)
+    # first get all appeals for this country
+    appeals = fetch_appeals_for_country(country)
     appeal_ids = appeals.index
     # then get all projects corresponding to those appeals and concatenate into one big frame
-    list_of_projects = [fts_queries.fetch_projects_json_for_appeal_as_dataframe(appeal_id) for appeal_id in appeal_ids]
-    list_of_non_empty_projects = filter_out_empty_dataframes(list_of_projects)
-    projects_frame = pd.concat(list_of_non_empty_projects)
-    write_dataframe_to_csv(projects_frame, build_csv_path(output_dir, 'projects', country=country))
+    # (skipping empty frames, which come from appeals with no projects)
+    list_of_projects = [frame for frame in
+                        fetch_all_concurrently(fts_queries.fetch_projects_json_for_appeal_as_dataframe, appeal_ids)
+                        if not frame.empty]
+    projects_frame = pd.concat(list_of_projects, copy=False)
+    write_dataframe(projects_frame, build_output_path(output_dir, 'projects', country=country))
 
 
 def produce_contributions_csv_for_country(output_dir, country):
-    # first get all emergencies for this country (could eliminate this duplicative call, but it's not expensive)
-    emergencies = fts_queries.fetch_emergencies_json_for_country_as_dataframe(country)
+    # first get all emergencies for this country
+    emergencies = fetch_emergencies_for_country(country)
     emergency_ids = emergencies.index
     # then get all contributions corresponding to those emergencies and concatenate into one big frame
-    list_of_contributions = [fts_queries.fetch_contributions_json_for_emergency_as_dataframe(emergency_id)
-                             for emergency_id in emergency_ids]
-    list_of_non_empty_contributions = filter_out_empty_dataframes(list_of_contributions)
-    contributions_master_frame = pd.concat(list_of_non_empty_contributions)
-    write_dataframe_to_csv(contributions_master_frame, build_csv_path(output_dir, 'contributions', country=country))
+    # (skipping empty frames, which come from emergencies with no contributions)
+    list_of_contributions = [frame for frame in
+                             fetch_all_concurrently(fts_queries.fetch_contributions_json_for_emergency_as_dataframe,
+                                                    emergency_ids)
+                             if not frame.empty]
+    contributions_master_frame = pd.concat(list_of_contributions, copy=False)
+    write_dataframe(contributions_master_frame, build_output_path(output_dir, 'contributions', country=country))
 
 
 def produce_csvs_for_country(base_output_dir, country):
     output_dir = os.path.join(base_output_dir, 'fts', 'per_country', country)
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+    make_directories(output_dir)
+
+    # the four CSVs are independent of each other (apart from the cached appeals/emergencies) and mostly wait on I/O
+    produce_functions = [produce_emergencies_csv_for_country, produce_appeals_csv_for_country,
+                         produce_projects_csv_for_country, produce_contributions_csv_for_country]
+    pool = ThreadPool(len(produce_functions))
+    try:
+        pool.map(lambda produce_function: produce_function(output_dir, country), produce_functions)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def init_country_worker(request_slots):
+    # each worker process needs its own connections to the FTS API rather than ones inherited from this process,
+    # but shares the limit on requests in flight
+    fts_queries.reset_session()
+    fts_queries.limit_concurrent_requests(request_slots)
+
 
-    produce_emergencies_csv_for_country(output_dir, country)
-    produce_appeals_csv_for_country(output_dir, country)
-    produce_projects_csv_for_country(output_dir, country)
-    produce_contributions_csv_for_country(output_dir, country)
+def produce_csvs_for_countries(base_output_dir, countries):
+    pool = Pool(MAX_CONCURRENT_COUNTRIES, initializer=init_country_worker, initargs=(_request_slots,))
+    try:
+        pool.map(partial(produce_csvs_for_country, base_output_dir), countries)
+    finally:
+        pool.close()
+        pool.join()
 
 
 if __name__ == "__main__":
@@ -117,5 +233,4 @@ if __name__ == "__main__":
     tmp_output_dir = '/tmp/'
 
     produce_global_csvs(tmp_output_dir)
-    for country_code in country_codes:
-        produce_csvs_for_country(tmp_output_dir, country_code)
+    produce_csvs_for_countries(tmp_output_dir, country_codes)
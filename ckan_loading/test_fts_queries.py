@@ -0,0 +1,34 @@
+"""
+Checks that don't need an internet connection. Run from this directory with: python -m unittest test_fts_queries
+"""
+
+import json
+import unittest
+
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+import fts_queries
+
+# shaped like a Project or Contribution response, covering the cases pd.read_json coerces (or leaves alone)
+SAMPLE_PAYLOAD = json.dumps([
+    {'id': 1, 'title': 'Food aid', 'amount': 1000.0, 'original_amount': '1000', 'exchange_rate': 1.5,
+     'end_date': None, 'sector': {'id': 3, 'name': 'Food'}, 'pledged': None, 'cluster_ids': [1, 2]},
+    {'id': 2, 'title': 'Shelter', 'amount': 250.0, 'original_amount': '25.5', 'exchange_rate': None,
+     'end_date': None, 'sector': {'id': 4, 'name': 'Shelter'}, 'pledged': 7, 'cluster_ids': []},
+])
+
+
+class CoerceDtypesLikeReadJsonTest(unittest.TestCase):
+
+    def test_matches_read_json(self):
+        coerced = fts_queries.coerce_dtypes_like_read_json(pd.DataFrame(json.loads(SAMPLE_PAYLOAD)))
+        assert_frame_equal(coerced, pd.read_json(SAMPLE_PAYLOAD), check_like=True)
+
+    def test_whole_valued_floats_become_integers(self):
+        coerced = fts_queries.coerce_dtypes_like_read_json(pd.DataFrame(json.loads(SAMPLE_PAYLOAD)))
+        self.assertEqual(coerced['amount'].dtype.kind, 'i')
+
+
+if __name__ == '__main__':
+    unittest.main()